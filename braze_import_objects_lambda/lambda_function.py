@@ -13,14 +13,21 @@ Prerequisites:
  - Braze REST API Key
 """
 
+import atexit
+import codecs
+import io
+import itertools
 import json
+import logging
 import os
+import re
 import boto3
-import requests
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, Generator, List, Optional
+import httpx
+import orjson
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Generator, Iterator, List, Optional
 from urllib.parse import unquote_plus
-from requests.exceptions import RequestException
 from tenacity import (
     RetryCallState,
     retry,
@@ -30,16 +37,28 @@ from tenacity import (
 )
 
 
-CHUNK_SIZE_1_MB = 10 ** 6
+CHUNK_SIZE_8_MB = 8 * 10 ** 6
+RANGE_SIZE_32_MB = 32 * 10 ** 6
 THREADS = int(os.environ.get("THREADS", 15))
+PREFETCH_THREADS = int(os.environ.get("PREFETCH_THREADS", 4))
 FUNCTION_TIME_LIMIT = 1000 * 60 * 3  # 3 minutes remaining from 15 minute timeout
 MAX_RETRIES = 5
+# Whitespace, commas and brackets between the objects of a JSON array
+ARRAY_SEPARATORS = re.compile(r"[ \t\n\r,\[\]]*")
+WHITESPACE_BYTES = re.compile(rb"[ \t\n\r]*")
+
+# Records propagate to the handler the Lambda runtime attaches to the root
+# logger. The level is only set on this module's logger, so that libraries
+# such as httpx, which logs every request at INFO, keep the root level.
+# Messages below the level are dropped before they are formatted
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
 
 try:
     BRAZE_API_KEY = os.environ["BRAZE_API_KEY"]
     BRAZE_API_URL = os.environ["BRAZE_API_URL"].rstrip('/')
 except KeyError:
-    print("ERROR: Braze API key or URL is missing. Cannot process the file")
+    LOGGER.error("Braze API key or URL is missing. Cannot process the file")
     raise 
 
 REQUEST_HEADERS = {
@@ -47,36 +66,63 @@ REQUEST_HEADERS = {
     "Authorization": f"Bearer {BRAZE_API_KEY}",
     "X-Braze-Bulk": "true"
 }
+# Parsed once instead of on every request
+USERS_TRACK_URL = httpx.URL(f"{BRAZE_API_URL}/users/track")
+
+# Requests from all sending threads are multiplexed over a single HTTP/2
+# connection, which is kept alive between batches and warm invocations.
+# The limits only come into play if the server falls back to HTTP/1.1
+HTTPX_CLIENT = httpx.Client(
+    http2=True,
+    headers=REQUEST_HEADERS,
+    limits=httpx.Limits(max_connections=THREADS, max_keepalive_connections=THREADS),
+    # The connection outlives frozen containers, a stalled request must
+    # fail and be retried instead of hanging until the lambda times out
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+atexit.register(HTTPX_CLIENT.close)
+
+# Sending threads are kept alive between batches and warm invocations
+EXECUTOR = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="braze")
+atexit.register(EXECUTOR.shutdown)
+
+# Created once per container, so following lambdas are invoked without
+# resolving credentials and endpoints again
+LAMBDA_CLIENT = boto3.client("lambda")
 
 def lambda_handler(event, context):
     bucket_name = event['Records'][0]['s3']['bucket']['name']
     object_key = unquote_plus(event['Records'][0]['s3']['object']['key'])
     byte_offset = event.get("byte_offset", 0)
+    is_ndjson = event.get("is_ndjson")
 
-    print(f"INFO: New Braze object import lambda invoked. Starting at byte {byte_offset}")
+    LOGGER.info("New Braze object import lambda invoked. Starting at byte %d", byte_offset)
 
     s3_file = get_s3_file(bucket_name, object_key)
-    processor = S3FileProcessor(s3_file, context, byte_offset)
+    processor = S3FileProcessor(s3_file, context, byte_offset, is_ndjson)
 
     try:
         processor.process_file()
     except Exception:
-        print(f"ERROR: Encountered a fatal error. Sent {processor.processed_objects_count} objects. Read {processor.total_bytes_read} bytes")
+        LOGGER.error(
+            "Encountered a fatal error. Sent %d objects. Read %d bytes",
+            processor.processed_objects_count, processor.parsed_bytes_read)
         raise
 
-    print(f"INFO: Processed {format_bytes_read(processor.total_bytes_read)} of the current file")
-    print(f"INFO: Imported {processor.processed_objects_count} objects")
+    LOGGER.info("Processed %s of the current file", format_bytes_read(processor.total_bytes_read))
+    LOGGER.info("Imported %d objects", processor.processed_objects_count)
 
     if not processor.is_finished():
         invoke_next_lambda(
             event,
             context.function_name,
             processor.total_bytes_read,
+            processor.is_ndjson,
         )
     else:
         if processor.has_leftover_bytes:
-            print("WARNING: Found unprocessed bytes. That could mean that JSON file was not formatted correctly and could not be parsed fully.")
-        print(f"INFO: Completed importing file {object_key}")
+            LOGGER.warning("Found unprocessed bytes. That could mean that JSON file was not formatted correctly and could not be parsed fully.")
+        LOGGER.info("Completed importing file %s", object_key)
 
     return {
         "objects_sent": processor.processed_objects_count,
@@ -91,92 +137,180 @@ class S3FileProcessor:
         s3_file,  # boto3.s3.Object
         lambda_context,  # lambda context object: https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
         byte_offset: int = 0,
+        is_ndjson: Optional[bool] = None,
     ) -> None:
         self.s3_file = s3_file
         self.lambda_context = lambda_context
         self.total_bytes_read = byte_offset
-        self.valid_chunk_bytes_read = 0
+        # Offset of the last full batch, only used to report progress
+        self.parsed_bytes_read = byte_offset
+        self.is_ndjson = is_ndjson
         self.processed_objects_count = 0
+        # Batches being sent in the background
+        self.pending_batches: Deque[Future] = deque()
 
         self.has_leftover_bytes = False
 
     def process_file(self) -> None:
-        all_parsed_objects, current_batch  = [], []
-        for braze_object in self.get_objects_from_file_stream():
-            current_batch.append(braze_object)
-
-            if len(current_batch) == 75:
-                all_parsed_objects.append(current_batch)
-                current_batch = []
-            
-            if len(all_parsed_objects) == THREADS:
-                self.send_objects_to_braze(all_parsed_objects)
-                if self.should_terminate():
-                    break
-                all_parsed_objects = []
-        else:
-            if current_batch:
-                all_parsed_objects.append(current_batch)
-            self.send_objects_to_braze(all_parsed_objects)
-
-        # Leftover bytes from the end of the file that include closing array
-        # bracket and whitespace
-        self.total_bytes_read += self.valid_chunk_bytes_read
+        # Events and purchases are batched separately, so that each request
+        # holds a single object type
+        batches: Dict[str, List[Dict]] = {"events": [], "purchases": []}
+        for braze_object, byte_offset in self.get_objects_from_file_stream():
+            if 'price' in braze_object and 'currency' in braze_object:
+                kind = "purchases"
+            else:
+                kind = "events"
+            batch = batches[kind]
+            batch.append(braze_object)
+
+            if len(batch) == 75:
+                self.parsed_bytes_read = byte_offset
+                self.submit_batch(batch, kind)
+                batches[kind] = []
+
+                if len(self.pending_batches) == THREADS * 2:
+                    self.complete_oldest_batch()
+                    if self.should_terminate():
+                        self.total_bytes_read = byte_offset
+                        break
+
+        # Partial batches are sent even when terminating early, the byte
+        # offset covers every object parsed so far. When the whole stream is
+        # read, the parser sets the offset itself, including the closing
+        # array bracket and whitespace after the last object.
+        for kind, batch in batches.items():
+            if batch:
+                self.submit_batch(batch, kind)
+
+        while self.pending_batches:
+            self.complete_oldest_batch()
 
     def get_objects_from_file_stream(self) -> Generator:
-        current_object = ""
-        current_bytes = 0
-        opened = 0
-        file_stream = self.s3_file.get(Range=f"bytes={self.total_bytes_read}-")["Body"]
-        for byte_chunk in file_stream.iter_chunks(chunk_size=CHUNK_SIZE_1_MB):
-            for line_as_bytes in byte_chunk.splitlines(keepends=True):
-                current_bytes += len(line_as_bytes)
-                line = line_as_bytes.decode('utf-8').strip()
-
-                opened += line.count('{')
-                opened -= line.count('}')
-
-                if line and not opened:
-                    if line[-1] == ',':
-                        line = line[:-1]
-                
-                    is_single_line_array = line[0] == '[' and line[-1] == ']'
-                    if line and not is_single_line_array and line[0] == '[':
-                        line = line[1:]
-                    if line and not is_single_line_array and line[-1] == ']':
-                        line = line[:-1]
-
-                # Not a valid object, but a valid line, such as opening 
-                # array bracket on a single line
-                if not line:
-                    self.valid_chunk_bytes_read += current_bytes
-                    current_bytes = 0
-                    continue
-
-                current_object += line
+        """Yields parsed objects along with the file offset right after each
+        of them.
+        """
+        byte_chunks = stream_file_chunks(self.s3_file, self.total_bytes_read)
+
+        # The format can only be detected at the start of the file, following
+        # lambdas receive it in the event
+        if self.is_ndjson is None and not self.total_bytes_read:
+            byte_chunks = self.detect_file_format(byte_chunks)
+
+        if self.is_ndjson:
+            yield from self.get_objects_from_ndjson_stream(byte_chunks)
+        else:
+            yield from self.get_objects_from_array_stream(byte_chunks)
+
+    def detect_file_format(self, byte_chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """Peeks at the first non-whitespace byte of the file. Files that start
+        with an object, rather than an array, are treated as newline delimited
+        JSON with one object per line.
+        """
+        peeked_chunks = []
+        for byte_chunk in byte_chunks:
+            peeked_chunks.append(byte_chunk)
+            first_byte = WHITESPACE_BYTES.match(byte_chunk).end()
+            if first_byte < len(byte_chunk):
+                self.is_ndjson = byte_chunk[first_byte] == ord('{')
+                break
+        return itertools.chain(peeked_chunks, byte_chunks)
+
+    def get_objects_from_ndjson_stream(self, byte_chunks: Iterator[bytes]) -> Generator:
+        """Fast path for files with one object per line. Each line is parsed
+        as is, without any bracket bookkeeping.
+        """
+        bytes_read = self.total_bytes_read
+        partial_line = b""
+        for byte_chunk in byte_chunks:
+            # Iterating a BytesIO splits lines lazily in C, in a single pass
+            # and without building a list of every line in the chunk
+            lines = io.BytesIO(byte_chunk)
+            if partial_line:
+                lines = itertools.chain([partial_line + lines.readline()], lines)
+                partial_line = b""
+
+            for line in lines:
                 try:
-                    event_data = json.loads(current_object)
-                    self.valid_chunk_bytes_read += current_bytes
-                    current_bytes = 0
-                    current_object = ""
-
-                    if isinstance(event_data, list):
-                        for event in event_data:
-                            yield event
+                    braze_object = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    if line[-1:] != b'\n':
+                        # The line continues in the next chunk
+                        partial_line = line
                     else:
-                        yield event_data
+                        self.skip_invalid_line(line, bytes_read)
+                        bytes_read += len(line)
+                    continue
+                bytes_read += len(line)
+                yield braze_object, bytes_read
+
+        if partial_line:
+            try:
+                braze_object = orjson.loads(partial_line)
+            except orjson.JSONDecodeError:
+                self.skip_invalid_line(partial_line, bytes_read)
+                bytes_read += len(partial_line)
+            else:
+                bytes_read += len(partial_line)
+                yield braze_object, bytes_read
+
+        self.total_bytes_read = bytes_read
+
+    def skip_invalid_line(self, line: bytes, byte_offset: int) -> None:
+        """Logs a line that is not valid JSON. Blank lines are skipped quietly.
+        Any following lambda starts past the line, so this is the only record
+        of it."""
+        if not line.strip():
+            return
+        self.has_leftover_bytes = True
+        LOGGER.warning("Skipped a line that is not valid JSON at byte %d", byte_offset)
+
+    def get_objects_from_array_stream(self, byte_chunks: Iterator[bytes]) -> Generator:
+        """Parses objects from a JSON array, pretty printed or not. Objects
+        are decoded one at a time from a text buffer, so an object that spans
+        many lines is parsed once instead of on every line.
+
+        Chunks are decoded to text once, since finding object boundaries in
+        bytes with Python code is several times slower than raw_decode.
+        """
+        # NaN and Infinity are not valid JSON, orjson would send them as null
+        decoder = json.JSONDecoder(parse_constant=lambda constant: None)
+        utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        buffer, position = "", 0
+        bytes_read = self.total_bytes_read
+        for byte_chunk in byte_chunks:
+            buffer = buffer[position:] + utf8_decoder.decode(byte_chunk)
+            position = 0
+
+            while True:
+                object_start = ARRAY_SEPARATORS.match(buffer, position).end()
+                if object_start == len(buffer):
+                    break
+                try:
+                    braze_object, object_end = decoder.raw_decode(buffer, object_start)
                 except json.JSONDecodeError:
-                    pass
+                    # The object continues in the next chunk
+                    break
+
+                bytes_read += get_byte_length(buffer, position, object_end)
+                position = object_end
+                yield braze_object, bytes_read
+
+        buffer += utf8_decoder.decode(b"", final=True)
+        if ARRAY_SEPARATORS.match(buffer, position).end() == len(buffer):
+            bytes_read += get_byte_length(buffer, position, len(buffer))
         else:
-            self.has_leftover_bytes = bool(current_object)
-        
+            self.has_leftover_bytes = True
+
+        self.total_bytes_read = bytes_read
 
-    def send_objects_to_braze(self, objects: List[List[Dict]]) -> None:
-        sent_objects = send_object_chunks_to_braze(objects)
-        self.processed_objects_count += sent_objects
-        self.total_bytes_read += self.valid_chunk_bytes_read
-        self.valid_chunk_bytes_read = 0
+    def submit_batch(self, objects: List[Dict], kind: str) -> None:
+        """Sends a batch of up to 75 events or purchases in the background, so
+        that the file can keep being parsed while waiting for the Braze API."""
+        self.pending_batches.append(EXECUTOR.submit(send_objects_to_braze, objects, kind))
 
+    def complete_oldest_batch(self) -> None:
+        """Waits for the oldest batch to be sent and counts its objects."""
+        self.processed_objects_count += self.pending_batches.popleft().result()
 
     def should_terminate(self) -> bool:
         return self.lambda_context.get_remaining_time_in_millis() < FUNCTION_TIME_LIMIT
@@ -197,39 +331,53 @@ def get_s3_file(
     return boto3.resource("s3").Object(bucket_name, object_key)   # type: ignore
 
 
-def send_object_chunks_to_braze(object_chunks: List[List[Dict]]) -> int:
-    """Sends a batch of requests to the Braze API. Expects a list of 75 object
-    chunks. Each chunk will be sent to the API in its own thread and it will be
-    retried independently in case of an error.
+def stream_file_chunks(s3_file, byte_offset: int) -> Generator:
+    """Streams the file starting from the byte offset. A single connection to
+    S3 is capped in throughput, so consecutive byte ranges are downloaded in
+    parallel ahead of the parser and the chunks are yielded in file order.
     """
-    sent = 0
-    with ThreadPoolExecutor(max_workers=THREADS) as executor:
-        results = executor.map(send_objects_to_braze, object_chunks)
-        for result in results:
-            sent += result
-    if sent:
-        print(f"INFO: Successfully sent {sent} objects to Braze")
-    return sent
+    file_size = s3_file.content_length
+    downloads = deque()
+    executor = ThreadPoolExecutor(max_workers=PREFETCH_THREADS, thread_name_prefix="s3")
+    try:
+        for range_start in range(byte_offset, file_size, RANGE_SIZE_32_MB):
+            if len(downloads) == PREFETCH_THREADS * 2:
+                yield from downloads.popleft().result()
+            range_end = min(range_start + RANGE_SIZE_32_MB, file_size) - 1
+            downloads.append(
+                executor.submit(download_file_range, s3_file, range_start, range_end))
+
+        while downloads:
+            yield from downloads.popleft().result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def download_file_range(s3_file, range_start: int, range_end: int) -> List[bytes]:
+    # boto3 resources are not thread safe, the underlying client is
+    response = s3_file.meta.client.get_object(
+        Bucket=s3_file.bucket_name,
+        Key=s3_file.key,
+        Range=f"bytes={range_start}-{range_end}",
+    )
+    return list(response["Body"].iter_chunks(chunk_size=CHUNK_SIZE_8_MB))
 
 
 def on_network_retry_error(state: RetryCallState):
-    print(
-        f"Retry attempt: {state.attempt_number}/{MAX_RETRIES}. Wait time: {state.idle_for}")
+    LOGGER.warning(
+        "Retry attempt: %d/%d. Wait time: %s", state.attempt_number, MAX_RETRIES, state.idle_for)
 
 
-@retry(retry=retry_if_exception_type(RequestException),
-       wait=wait_exponential(multiplier=5, min=5),
-       stop=stop_after_attempt(MAX_RETRIES),
-       after=on_network_retry_error,
-       reraise=True)
-def send_objects_to_braze(objects: List[Dict]) -> int:
-    """Sends a chunk of 75 objects to Braze. Parses the response and prints
+def send_objects_to_braze(objects: List[Dict], kind: str) -> int:
+    """Sends a chunk of up to 75 objects to Braze. Parses the response and logs
     whether any of the objects were not possible to be parsed by Braze. Raises
     an exception in case it encounters an error response.
     Return the number of objects that were successfully sent to Braze.
 
     :param objects: List of object dictionaries representing custom events
                     or purchases
+    :param kind: Request field the objects are sent in, either "events" or
+                 "purchases"
     :returns: Number of successfully imported objects
     :raises: APIRetryError - if a retryable error occurred such as an unresponsive
                              server
@@ -239,37 +387,51 @@ def send_objects_to_braze(objects: List[Dict]) -> int:
     if not objects:
         return 0
 
-    events, purchases = [], []
-    for candidate in objects:
-        if 'price' in candidate and 'currency' in candidate:
-            purchases.append(candidate)
-        else:
-            events.append(candidate)
+    # Serialized once, retries send the same body
+    try:
+        body = orjson.dumps({kind: objects})
+    except orjson.JSONEncodeError:
+        # Integers outside of the 64-bit range, parsed from JSON arrays
+        body = json.dumps({kind: objects}).encode()
+    return post_objects_to_braze(body, len(objects))
 
-    # print(f"DEBUG: Sending {len(events)} events and {len(purchases)} purchases")
-    
-    data = {}
-    if events:
-        data['events'] = events
-    if purchases:
-        data['purchases'] = purchases
-
-    response = requests.post(
-        f"{BRAZE_API_URL}/users/track",
-        headers=REQUEST_HEADERS, 
-        data=json.dumps(data)
-    )
 
-    response_msg = response.json()
-    if response.status_code == 201 and 'errors' in response_msg:
-        print(f"ERROR: Encountered errors processing some users: {response_msg.get('errors')}")
+@retry(retry=retry_if_exception_type(httpx.HTTPError),
+       wait=wait_exponential(multiplier=5, min=5),
+       stop=stop_after_attempt(MAX_RETRIES),
+       after=on_network_retry_error,
+       reraise=True)
+def post_objects_to_braze(body: bytes, object_count: int) -> int:
+    """Posts a serialized request body to the Braze API. The body is passed
+    to the connection as is and sent with a Content-Length header.
+
+    :param body: JSON encoded request body with events and purchases
+    :param object_count: Number of objects in the request body
+    :returns: Number of successfully imported objects
+    """
+    # Request headers are set on the client
+    response = HTTPX_CLIENT.post(USERS_TRACK_URL, content=body)
 
-    if response.status_code == 400:
-        print(f"ERROR: Encountered error for user chunk. {response.text}")
-    
     if response.status_code == 429 or response.status_code >= 500:
         raise APIRetryError("Server error. Retrying..")
 
+    # A successful response without errors means that every object was
+    # processed, no need to parse it
+    response_content = response.content
+    if response.status_code == 201 and b'"errors"' not in response_content:
+        return object_count
+
+    try:
+        response_msg = orjson.loads(response_content) if response_content else {}
+    except orjson.JSONDecodeError:
+        # Such as HTML error pages from a gateway, reported with the raw text
+        response_msg = {}
+    if response.status_code == 201 and 'errors' in response_msg:
+        LOGGER.error("Encountered errors processing some users: %s", response_msg.get('errors'))
+
+    if response.status_code == 400:
+        LOGGER.error("Encountered error for user chunk. %s", response.text)
+
     if response.status_code > 400:
         raise FatalAPIError(response_msg.get('message', response.text))
     
@@ -277,20 +439,37 @@ def send_objects_to_braze(objects: List[Dict]) -> int:
 
 
 
-def invoke_next_lambda(event: Dict, function_name: str, byte_offset: int) -> None:
-    print("INFO: Invoking lambda to continue processing the file")
+def invoke_next_lambda(
+    event: Dict,
+    function_name: str,
+    byte_offset: int,
+    is_ndjson: Optional[bool] = None,
+) -> None:
+    LOGGER.info("Invoking lambda to continue processing the file")
     event = {
         **event,
-        "byte_offset": byte_offset
+        "byte_offset": byte_offset,
+        "is_ndjson": is_ndjson,
     }
 
-    boto3.client("lambda").invoke(
+    LAMBDA_CLIENT.invoke(
         FunctionName=function_name,
         InvocationType="Event",
-        Payload=json.dumps(event),
+        Payload=orjson.dumps(event),
     )
 
 
+def get_byte_length(text: str, start: int, end: int) -> int:
+    """Returns the UTF-8 encoded length of a slice of the text. Only slices
+    with non-ASCII characters are encoded."""
+    if text.isascii():
+        return end - start
+    text_slice = text[start:end]
+    if text_slice.isascii():
+        return end - start
+    return len(text_slice.encode())
+
+
 def format_bytes_read(byte_count: int) -> str:
     if byte_count >= 10 ** 9:
         return f"{byte_count / (10 ** 9):,.1f} GB"
@@ -301,7 +480,7 @@ def format_bytes_read(byte_count: int) -> str:
     return f"{byte_count} B"
 
 
-class APIRetryError(RequestException):
+class APIRetryError(httpx.HTTPError):
     """Raised on 429 or 5xx server exception. If there are retries left, the
     API call will be made again after a delay."""
     pass
@@ -12,7 +12,7 @@ fi
 
 echo "Packaging depencies"
 cd braze_import_objects_lambda
-pip install --target ./package requests tenacity
+pip install --target ./package "httpx[http2]" tenacity orjson
 echo "Packaging the app"
 cd package
 zip -r ../braze-import-objects-lambda-v"$VERSION".zip .